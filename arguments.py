@@ -1,5 +1,12 @@
 import argparse
 
+def str2bool(value):
+    if value.lower() in ('true', 'yes', '1'):
+        return True
+    if value.lower() in ('false', 'no', '0'):
+        return False
+    raise argparse.ArgumentTypeError("Boolean value expected, got {}".format(value))
+
 def get_args():
     parser = argparse.ArgumentParser(description="model parameters")
 
@@ -34,10 +41,16 @@ def get_args():
     # Others
     parser.add_argument('--cpu', action='store_true',
                         help="Set this to use CPU, default use CUDA")
+    parser.add_argument('--amp', action='store_true',
+                        help="Train with mixed precision (CUDA only)")
+    parser.add_argument('--compile', action='store_true',
+                        help="Compile the model with torch.compile")
     parser.add_argument('--n-workers', type=int, default=4,
                         help="How many processes for preprocessing")
-    parser.add_argument('--pin-mem', type=bool, default=False,
+    parser.add_argument('--pin-mem', type=str2bool, default=True,
                         help="DataLoader pin memory or not")
+    parser.add_argument('--no-pin-mem', action='store_false', dest='pin_mem',
+                        help="Set this to disable DataLoader pinned memory")
     parser.add_argument('--log-freq', type=int, default=100,
                         help="Logging frequency")
     parser.add_argument('--seed', type=int, default=420,
@@ -7,7 +7,8 @@ import pdb
 import pickle
 
 import torch
-from torch.utils.data import Dataset, SubsetRandomSampler
+from torch.utils.data import Dataset, Subset, SubsetRandomSampler
+from torch.utils.data.distributed import DistributedSampler
 import numpy as np
 from tqdm import tqdm
 
@@ -83,23 +84,84 @@ def prepare_data(args):
     train_indices, val_indices = indices[split:], indices[:split]
 
     # Creating PT data samplers and loaders:
-    train_sampler = SubsetRandomSampler(train_indices)
-    valid_sampler = SubsetRandomSampler(val_indices)
-
-    train_loader = torch.utils.data.DataLoader(dataset_vqa,
+    if args.distributed:
+        # every rank sees a disjoint shard of each split
+        train_set = Subset(dataset_vqa, train_indices)
+        train_sampler = DistributedSampler(train_set, shuffle=True, seed=random_seed)
+        val_set = Subset(dataset_vqa, val_indices)
+        valid_sampler = DistributedSampler(val_set, shuffle=False)
+    else:
+        train_set = val_set = dataset_vqa
+        train_sampler = SubsetRandomSampler(train_indices)
+        valid_sampler = SubsetRandomSampler(val_indices)
+
+    loader_kwargs = {'batch_size': args.batch_size,
+                     'num_workers': args.n_workers,
+                     'pin_memory': args.pin_mem and not args.cpu}
+
+    # training workers stay alive across epochs and keep more batches in flight
+    train_kwargs = dict(loader_kwargs)
+    if args.n_workers > 0:
+        train_kwargs.update(persistent_workers=True, prefetch_factor=4)
+
+    # with --compile, a fixed batch shape lets torch.compile reuse one graph
+    train_loader = torch.utils.data.DataLoader(train_set,
                                                sampler=train_sampler,
-                                               batch_size=args.batch_size,
-                                               num_workers=args.n_workers,
-                                               pin_memory=args.pin_mem)
+                                               drop_last=args.compile,
+                                               **train_kwargs)
 
 
-    val_loader = torch.utils.data.DataLoader(dataset_vqa,
+    val_loader = torch.utils.data.DataLoader(val_set,
                                                sampler=valid_sampler,
-                                               batch_size=args.batch_size,
-                                               num_workers=args.n_workers,
-                                               pin_memory=args.pin_mem)
+                                               **loader_kwargs)
 
 
     vocab_size = VqaDataset.get_vocab_size()
     num_classes = VqaDataset.get_n_classes()
     return train_loader, val_loader, vocab_size, num_classes
+
+
+class DataPrefetcher:
+
+    def __init__(self, loader, device, fields=(0, 1, 2, 3)):
+        """
+        loader (DataLoader): loader to wrap
+        device (torch.device): where to move the batches
+        fields (tuple): positions in a batch of the tensors to move
+        """
+        self.loader = loader
+        self.device = device
+        self.fields = fields
+        self.stream = torch.cuda.Stream() if device.type == 'cuda' else None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        batches = iter(self.loader)
+        batch = self.preload(next(batches, None))
+        while batch is not None:
+            if self.stream is not None:
+                current = torch.cuda.current_stream()
+                current.wait_stream(self.stream)
+                for i in self.fields:
+                    batch[i].record_stream(current)
+            next_batch = self.preload(next(batches, None))
+            yield batch
+            batch = next_batch
+
+    def preload(self, batch):
+        """Issue the host to device copies of the next batch on a side stream"""
+        if batch is None:
+            return None
+
+        batch = list(batch)
+        if self.stream is None:
+            for i in self.fields:
+                batch[i] = batch[i].to(self.device)
+            return batch
+
+        with torch.cuda.stream(self.stream):
+            for i in self.fields:
+                batch[i] = batch[i].to(self.device, non_blocking=True)
+        return batch
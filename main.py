@@ -9,66 +9,89 @@ import argparse
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
 import numpy as np
 from tqdm import tqdm
 
 from model import Model
-from utils import GOATLogger, save_ckpt, compute_score
-from data_loader import prepare_data
+from utils import GOATLogger, save_ckpt, compute_score, upgrade_optim_state
+from data_loader import prepare_data, DataPrefetcher
 from arguments import get_args
 
 
-def evaluate(val_loader, model, epoch, device, logger):
+def evaluate(val_loader, model, epoch, device, logger, amp=False):
     model.eval()
     loss = nn.CrossEntropyLoss()
 
     batches = len(val_loader)
-    for step, (v, q, a, gt, _, _) in enumerate(tqdm(val_loader, ascii=True)):
-        v = v.to(device)
-        q = q.to(device)
-        a = a.to(device)
-        gt = gt.to(device)
-
-        logits = model(v, q, a)
-        output = loss(logits, gt)
-
-        score = compute_score(logits, gt)
-
-        logger.batch_info_eval(epoch, step, batches, output.item(), score)
+    results = torch.empty((batches, 2), device=device)  # loss, score per batch
+    with torch.no_grad():
+        for step, (v, q, a, gt, _, _) in enumerate(tqdm(DataPrefetcher(val_loader, device), ascii=True,
+                                                           disable=not logger.is_main)):
+            with torch.autocast(device.type, enabled=amp):
+                logits = model(v, q, a)
+                output = loss(logits, gt)
+
+            results[step, 0] = output
+            results[step, 1] = compute_score(logits, gt)
+
+    if dist.is_initialized():
+        # every rank ran the same number of batches over its own shard
+        dist.all_reduce(results)
+        results /= dist.get_world_size()
+
+    # a single copy back to host once the whole split is done
+    for step, (output, score) in enumerate(results.tolist()):
+        logger.batch_info_eval(epoch, step, batches, output, score)
 
     score = logger.batch_info_eval(epoch, -1, batches)
     return score
 
 
-def train(train_loader, model, optim, epoch, device, logger, moving_loss):
+def train(train_loader, model, optim, scaler, epoch, device, logger, moving_loss):
     model.train()
     loss = nn.CrossEntropyLoss()
     smooth_const = 0.1
+    params = [p for p in model.parameters() if p.requires_grad]
 
     batches = len(train_loader)
-    start = time.time()
-    for step, (v, q, a, gt, _, _) in enumerate(train_loader):
-        data_time = time.time() - start
-
-        v = v.to(device)
-        q = q.to(device)
-        a = a.to(device)
-        gt = gt.to(device)
-
-        logits = model(v, q, a)
-        output = loss(logits, gt)
+    start = window_start = time.time()
+    window_step, data_time = 0, 0.0
+    for step, (v, q, a, gt, _, _) in enumerate(DataPrefetcher(train_loader, device)):
+        data_time += time.time() - start
+
+        with torch.autocast(device.type, enabled=scaler.is_enabled()):
+            logits = model(v, q, a)
+            output = loss(logits, gt)
+
+        optim.zero_grad(set_to_none=True)
+        scaler.scale(output).backward()
+        scaler.unscale_(optim)
+        nn.utils.clip_grad_norm_(params, 0.25, foreach=True)
+        scaler.step(optim)
+        scaler.update()
+
+        # kept on device so the step never waits on a host read
+        batch_loss = output.detach().float()
+        moving_loss = (batch_loss if epoch == 0 and step == 0 else
+                        (1 - smooth_const) * moving_loss + smooth_const * batch_loss)
 
-        optim.zero_grad()
-        output.backward()
-        nn.utils.clip_grad_norm_(model.parameters(), 0.25)
-        optim.step()
-
-        moving_loss = (output.item() if epoch == 0 and step ==0 else 
-                        (1 - smooth_const) * moving_loss + smooth_const * output.item())
-
-        batch_time = time.time() - start
         score = compute_score(logits, gt)
+
+        # kernels run asynchronously, so only time whole logging windows
+        # once the device has caught up with the host
+        batch_time = 0.0
+        log_step = logger.log_step(step, batches)
+        if log_step:
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            window = step + 1 - window_step
+            batch_time = (time.time() - window_start) / window
+            data_time /= window
         logger.batch_info(epoch, step, batches, data_time, moving_loss, score, batch_time)
+        if log_step:
+            window_start, window_step, data_time = time.time(), step + 1, 0.0
         start = time.time()
 
     return moving_loss
@@ -81,53 +104,79 @@ def main():
     if len(unparsed) != 0:
         raise NameError("Argument {} not recognized".format(unparsed))
 
-    logger = GOATLogger(args.mode, args.save, args.log_freq)
+    # Launched through torchrun: one process per GPU
+    args.distributed = 'LOCAL_RANK' in os.environ
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    is_main = int(os.environ.get('RANK', 0)) == 0
+
+    logger = GOATLogger(args.mode, args.save, args.log_freq, is_main)
     random.seed(args.seed)
     torch.manual_seed(args.seed)
     if args.cpu:
+        args.amp = False
         device = torch.device('cpu')
     else:
         if not torch.cuda.is_available():
             raise RuntimeError("GPU unavailable.")
 
-        args.devices = torch.cuda.device_count()
-        args.batch_size *= args.devices
+        torch.cuda.set_device(local_rank)
         torch.backends.cudnn.benchmark = True
-        device = torch.device('cuda')
+        device = torch.device('cuda', local_rank)
         torch.cuda.manual_seed(args.seed)
 
+    if args.distributed:
+        dist.init_process_group('gloo' if args.cpu else 'nccl')
+
     # Get data
     train_loader, val_loader, vocab_size, num_answers = prepare_data(args)
 
     # Set up model
-    model = Model(vocab_size, args.word_embed_dim, args.hidden_size, args.resnet_out, num_answers)
-    model = nn.DataParallel(model).to(device)
-    logger.loginfo("Parameters: {:.3f}M".format(sum(p.numel() for p in model.parameters()) / 1e6))
+    net = Model(vocab_size, args.word_embed_dim, args.hidden_size, args.resnet_out, num_answers).to(device)
+    model = net
+    if args.distributed:
+        model = DistributedDataParallel(net, device_ids=None if args.cpu else [local_rank])
+    if args.compile:
+        model = torch.compile(model, mode='reduce-overhead')
+    logger.loginfo("Parameters: {:.3f}M".format(sum(p.numel() for p in net.parameters()) / 1e6))
 
     # Set up optimizer
-    optim = torch.optim.Adam(model.parameters(), 2e-4)
+    optim = torch.optim.Adam(model.parameters(), 2e-4, fused=device.type == 'cuda')
+    scaler = torch.amp.GradScaler(device.type, enabled=args.amp)
 
     last_epoch = 0
     bscore = 0.0
-    moving_loss = 0.0
+    moving_loss = torch.zeros((), device=device)
 
     if args.resume:
         logger.loginfo("Initialized from ckpt: " + args.resume)
         ckpt = torch.load(args.resume, map_location=device)
         last_epoch = ckpt['epoch']
-        model.load_state_dict(ckpt['state_dict'])
-        optim.load_state_dict(ckpt['optim_state_dict'])
+        # strip the prefix left by checkpoints saved from nn.DataParallel
+        state_dict = {k[len('module.'):] if k.startswith('module.') else k: v
+                      for k, v in ckpt['state_dict'].items()}
+        net.load_state_dict(state_dict)
+        optim_state = ckpt['optim_state_dict']
+        if any('.i2t.' in k for k in state_dict):
+            # saved before GatedTanh fused its transform and gate layers
+            optim_state = upgrade_optim_state(optim_state, list(state_dict),
+                                              [n for n, _ in net.named_parameters()])
+        optim.load_state_dict(optim_state)
 
     if args.mode == 'eval':
-        _ = evaluate(val_loader, model, last_epoch, device, logger)
+        _ = evaluate(val_loader, model, last_epoch, device, logger, args.amp)
         return
 
     # Train
     for epoch in range(last_epoch, args.epoch):
-        moving_loss = train(train_loader, model, optim, epoch, device, logger, moving_loss)
-        score = evaluate(val_loader, model, epoch, device, logger)
-        bscore = save_ckpt(score, bscore, epoch, model, optim, args.save, logger)
-
+        if args.distributed:
+            train_loader.sampler.set_epoch(epoch)
+        moving_loss = train(train_loader, model, optim, scaler, epoch, device, logger, moving_loss)
+        score = evaluate(val_loader, model, epoch, device, logger, args.amp)
+        if is_main:
+            bscore = save_ckpt(score, bscore, epoch, net, optim, args.save, logger)
+
+    if args.distributed:
+        dist.destroy_process_group()
     logger.loginfo("Done")
 
 
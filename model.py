@@ -9,26 +9,42 @@ class GatedTanh(nn.Module):
     def __init__(self, inp_size, out_size):
 
         super(GatedTanh, self).__init__()
-        self.i2t = nn.Linear(inp_size, out_size)  # input to transform
-        self.i2g = nn.Linear(inp_size, out_size)  # input to gate
+        # input to transform and input to gate, computed as one matmul
+        self.fused = nn.Linear(inp_size, 2*out_size)
+        self.out_size = out_size
 
     def forward(self, data):
 
-        inp2transform = torch.tanh(self.i2t(data))
-        inp2gate = torch.sigmoid(self.i2g(data))
-        gated_transform = torch.mul(inp2transform, inp2gate)
+        return self.gate(self.fused(data))
+
+    def gate(self, projected):
+
+        inp2transform, inp2gate = projected.split(self.out_size, dim=-1)
+        gated_transform = torch.mul(torch.tanh(inp2transform), torch.sigmoid(inp2gate))
 
         return gated_transform
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints from before the fusion hold separate i2t and i2g layers
+        for param in ('weight', 'bias'):
+            i2t, i2g = prefix + 'i2t.' + param, prefix + 'i2g.' + param
+            if i2t in state_dict and i2g in state_dict:
+                state_dict[prefix + 'fused.' + param] = torch.cat(
+                    (state_dict.pop(i2t), state_dict.pop(i2g)), 0)
+
+        super(GatedTanh, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
 class QuestionEncoder(nn.Module):
 
     def __init__(self, vocab_size, embed_dim, gru_hidden_size):
 
         super(QuestionEncoder, self).__init__()
         self.embeddings = nn.Embedding(vocab_size + 1, embed_dim)
-        pretrained_wemb = np.zeros((vocab_size + 1, embed_dim), dtype=np.float32)
-        pretrained_wemb[:vocab_size] = np.load(os.path.join('data', 'glove_pretrained_{}.npy'.format('question')))
-        self.embeddings.weight.data.copy_(torch.from_numpy(pretrained_wemb))
+        # read GloVe straight from the mapped file into the weight; the last row is padding
+        pretrained_wemb = self.embeddings.weight.data
+        pretrained_wemb.numpy()[:vocab_size] = np.load(
+            os.path.join('data', 'glove_pretrained_{}.npy'.format('question')), mmap_mode='r')
+        pretrained_wemb[vocab_size:].zero_()
 
         self.encoder = nn.GRU(embed_dim, gru_hidden_size)
         self.enc_mlp = nn.Linear(3*gru_hidden_size, gru_hidden_size)
@@ -36,11 +52,10 @@ class QuestionEncoder(nn.Module):
 
     def forward(self, data):
         data = self.embeddings(data)
-        self.encoder.flatten_parameters()
         outputs, hidden = self.encoder(data.permute(1,0,2))
-        max_pool_out = F.adaptive_max_pool1d(outputs.permute(1,2,0), 1).squeeze()
-        avg_pool_out = F.adaptive_avg_pool1d(outputs.permute(1,2,0), 1).squeeze()
-        cat_out = torch.cat((outputs[-1], max_pool_out, avg_pool_out), dim=1)
+        max_pool_out = outputs.amax(dim=0)  # pool over time, N * hidden
+        avg_pool_out = outputs.mean(dim=0)
+        cat_out = torch.cat((hidden.squeeze(0), max_pool_out, avg_pool_out), dim=1)
         cat_out = self.enc_mlp(cat_out)
         ques_enc = self.do(cat_out)
 
@@ -52,9 +67,11 @@ class AnswerEncoder(nn.Module):
 
         super(AnswerEncoder, self).__init__()
         self.embeddings = nn.Embedding(vocab_size + 1, embed_dim)
-        pretrained_wemb = np.zeros((vocab_size + 1, embed_dim), dtype=np.float32)
-        pretrained_wemb[:vocab_size] = np.load(os.path.join('data', 'glove_pretrained_{}.npy'.format('answer')))
-        self.embeddings.weight.data.copy_(torch.from_numpy(pretrained_wemb))
+        # read GloVe straight from the mapped file into the weight; the last row is padding
+        pretrained_wemb = self.embeddings.weight.data
+        pretrained_wemb.numpy()[:vocab_size] = np.load(
+            os.path.join('data', 'glove_pretrained_{}.npy'.format('answer')), mmap_mode='r')
+        pretrained_wemb[vocab_size:].zero_()
 
         self.MLP1 = nn.Linear(embed_dim, 2048)
         self.MLP2 = nn.Linear(2048, hidden_size)
@@ -77,9 +94,15 @@ class TopDownAttention(nn.Module):
         self.nonlinear = GatedTanh(inp_size, hidden_size)
         self.attn_layer = nn.Linear(hidden_size, 1)
 
-    def forward(self, data):
+    def forward(self, img_features, ques_features):
 
-        gated_transform = self.nonlinear(data)
+        # Linear([q, i]) == W_q q + W_i i, so the question is projected once
+        # and broadcast over the k regions instead of being copied k times
+        split = ques_features.size(-1)
+        weight, bias = self.nonlinear.fused.weight, self.nonlinear.fused.bias
+        ques_proj = F.linear(ques_features, weight[:, :split], bias)  # N * 2h
+        img_proj = F.linear(img_features, weight[:, split:])  # N * k * 2h
+        gated_transform = self.nonlinear.gate(ques_proj.unsqueeze(1) + img_proj)
         attn_scores = self.attn_layer(gated_transform)
         attn_probs = F.softmax(attn_scores, dim=1)
 
@@ -94,9 +117,7 @@ class ImageEncoder(nn.Module):
 
     def forward(self, img_features, ques_features):
 
-        ques_features = ques_features.unsqueeze(1).expand(-1,36,-1)  # N * k * enc_size
-        concat_features = torch.cat((ques_features, img_features), 2)  # N * k * (enc_size + img_size)
-        attn_probs = self.attention(concat_features)   # N * k * 1
+        attn_probs = self.attention(img_features, ques_features)   # N * k * 1
         img_encode = torch.sum(torch.mul(img_features, attn_probs), dim=1)
 
         return img_encode
@@ -126,19 +147,28 @@ class HybridClassifier(nn.Module):
         super(HybridClassifier, self).__init__()
         self.ques_nonlinear = GatedTanh(inp_size, text_embed_size)
         self.img_nonlinear = GatedTanh(inp_size, img_embed_size)
-        self.ques_linear = nn.Linear(text_embed_size, num_answers)
-        self.img_linear = nn.Linear(img_embed_size, num_answers)
+        # ques_linear(q) + img_linear(i) as one Linear over [q; i]
+        self.joint_linear = nn.Linear(text_embed_size + img_embed_size, num_answers)
 
     def forward(self, joint_embed):
 
         ques_embed = self.ques_nonlinear(joint_embed)
         img_embed = self.img_nonlinear(joint_embed)
-        ques_out = self.ques_linear(ques_embed)
-        img_out = self.img_linear(img_embed)
-        joint_output = torch.sigmoid(torch.add(ques_out, img_out))
+        joint_output = torch.sigmoid(self.joint_linear(torch.cat((ques_embed, img_embed), dim=-1)))
 
         return joint_output
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints from before the fusion hold separate ques and img layers
+        ques, img = prefix + 'ques_linear.', prefix + 'img_linear.'
+        if ques + 'weight' in state_dict and img + 'weight' in state_dict:
+            state_dict[prefix + 'joint_linear.weight'] = torch.cat(
+                (state_dict.pop(ques + 'weight'), state_dict.pop(img + 'weight')), 1)
+            state_dict[prefix + 'joint_linear.bias'] = \
+                state_dict.pop(ques + 'bias') + state_dict.pop(img + 'bias')
+
+        super(HybridClassifier, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
 
 class BasicClassifier(nn.Module):
 
@@ -150,7 +180,7 @@ class BasicClassifier(nn.Module):
 
     def forward(self, joint_embed):
 
-        output = F.sigmoid(self.classifier(self.nonlinear(joint_embed)))
+        output = torch.sigmoid(self.classifier(self.nonlinear(joint_embed)))
 
         return output
 
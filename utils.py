@@ -13,16 +13,21 @@ import matplotlib.pyplot as plt
 
 class GOATLogger:
 
-    def __init__(self, mode, save, log_freq=100):
+    def __init__(self, mode, save, log_freq=100, is_main=True):
         self.save_root = save
         self.log_freq = log_freq
+        self.is_main = is_main
         self.stats = {
             'train': {'iter': [], 'loss': [], 'score': []},
             'eval': {'epoch': [], 'loss': [], 'score': []},
             'xaxis': {'train': 'iter', 'eval': 'epoch'}
         }
+        self.pending = []
 
-        if mode == 'train':
+        if not is_main:
+            # only the first distributed rank writes logs and stats
+            logging.basicConfig(level=logging.WARNING)
+        elif mode == 'train':
             if not os.path.exists(self.save_root):
                 os.mkdir(self.save_root)
             filename = os.path.join(self.save_root, 'console.log')
@@ -42,17 +47,26 @@ class GOATLogger:
                 datefmt='%b-%d %H:%M:%S')
 
     def batch_info(self, epoch, step, batches, data_time, loss, score, batch_time):
-        if (step+1) % self.log_freq == 0 or (step+1) == batches:
+        # loss and score are 0-dim device tensors, read back only when logging
+        g_step = step + batches * epoch
+        self.pending.append((g_step, loss, score))
+
+        if self.log_step(step, batches):
+            iters, losses, scores = zip(*self.pending)
+            losses, scores = torch.stack((torch.stack(losses), torch.stack(scores))).tolist()
+            self.pending = []
+            self.stats['train']['iter'].extend(iters)
+            self.stats['train']['loss'].extend(losses)
+            self.stats['train']['score'].extend(scores)
+
             strout = "[{:3d}][{:4d}/{:4d}] ".format(epoch+1, step+1, batches) + \
-                "time for data/train: {:6.4f}/{:6.4f}, loss: {:6.4f}, score: {:6.3f}".format(\
-                    data_time, batch_time, loss, score)
+                "avg time per step for data/total: {:6.4f}/{:6.4f}, loss: {:6.4f}, score: {:6.3f}".format(\
+                    data_time, batch_time, losses[-1], scores[-1])
             self.loginfo(strout)
             self.save_stats('train')
 
-        g_step = step + batches * epoch
-        self.stats['train']['iter'].append(g_step)
-        self.stats['train']['loss'].append(loss)
-        self.stats['train']['score'].append(score)
+    def log_step(self, step, batches):
+        return (step+1) % self.log_freq == 0 or (step+1) == batches
 
     def batch_info_eval(self, epoch, step, batches, loss=0, score=0):
         if step == -1:
@@ -71,6 +85,9 @@ class GOATLogger:
 
 
     def save_stats(self, phase='train'):
+        if not self.is_main:
+            return
+
         data = pd.DataFrame(self.stats[phase])
         data.to_csv(os.path.join(self.save_root, 'stats_{}.csv'.format(phase)))
         xaxis = self.stats['xaxis'][phase]
@@ -97,8 +114,39 @@ class GOATLogger:
 
 
 def compute_score(logits, labels):
-    preds = torch.max(logits, dim=1)[1] == labels
-    return preds.cpu().numpy().sum() / logits.shape[0]
+    preds = logits.argmax(dim=1) == labels
+    return preds.float().mean()
+
+
+def upgrade_optim_state(optim_state, old_names, new_names):
+    """
+    Map optimizer state saved before GatedTanh fused its i2t and i2g layers
+    onto the fused parameter layout.
+    optim_state (dict): optimizer state_dict from the checkpoint
+    old_names (list): checkpoint parameter names, in parameter order
+    new_names (list): current parameter names, in parameter order
+    """
+    old_state = optim_state['state']
+    old_index = {name: i for i, name in enumerate(old_names)}
+
+    state = {}
+    for i, name in enumerate(new_names):
+        if name in old_index:
+            parts = [old_index[name]]
+        else:
+            prefix, _, param = name.rpartition('fused.')
+            parts = [old_index[prefix + 'i2t.' + param], old_index[prefix + 'i2g.' + param]]
+        if not all(j in old_state for j in parts):
+            continue
+
+        entries = [old_state[j] for j in parts]
+        # per-element moments are concatenated like the weights, scalars such as step are shared
+        state[i] = {key: torch.cat([e[key] for e in entries], 0)
+                    if torch.is_tensor(value) and value.dim() > 0 else value
+                    for key, value in entries[0].items()}
+
+    group = dict(optim_state['param_groups'][0], params=list(range(len(new_names))))
+    return {'state': state, 'param_groups': [group]}
 
 
 def save_ckpt(score, bscore, epoch, model, optim, save, logger):